@@ -1,67 +1,474 @@
+import asyncio
+import hashlib
 import io
 import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 
 import torch
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile
 from PIL import Image
 from transformers import AutoModelForCausalLM, AutoProcessor
 
+try:
+    from turbojpeg import TJPF_RGB, TurboJPEG
+
+    _jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # PyTurboJPEG or libturbojpeg missing: fall back to PIL for JPEGs too.
+    _jpeg = None
+
 MODEL_ID = os.getenv("FLORENCE_MODEL_ID", "microsoft/Florence-2-base")
 DEFAULT_TASK = "<CAPTION>"
+# Per-task (num_beams, max_new_tokens) defaults; short captions gain little from beam search.
+TASK_GENERATION = {
+    "<CAPTION>": (1, 64),
+    "<DETAILED_CAPTION>": (3, 256),
+    "<MORE_DETAILED_CAPTION>": (3, 256),
+}
+DEFAULT_GENERATION = (3, 256)
+MAX_BEAMS = 5
+MAX_NEW_TOKENS = 1024
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-DTYPE = torch.float16 if DEVICE == "cuda" else torch.float32
+if DEVICE == "cuda":
+    # BF16 matches FP16 throughput on Ampere+ without its overflow issues.
+    DTYPE = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+else:
+    DTYPE = torch.float32
+# Optional 8-bit weight-only quantization (bitsandbytes) for GPUs short on memory bandwidth.
+LOAD_IN_8BIT = DEVICE == "cuda" and os.getenv("FLORENCE_LOAD_IN_8BIT", "0") == "1"
+# torch.compile the vision tower and decoder (opt-in: first compile takes minutes).
+COMPILE = os.getenv("FLORENCE_COMPILE", "0") == "1"
+# e.g. "sdpa" to route decoder attention through scaled_dot_product_attention,
+# which picks flash/mem-efficient kernels when eligible. The DaViT vision tower
+# has its own attention and is unaffected.
+ATTN_IMPL = os.getenv("FLORENCE_ATTN_IMPL", "")
+# Replay the vision encoder from a CUDA graph for full GPU_BATCH batches
+# (torch.compile's reduce-overhead mode already does this when enabled; int8
+# bitsandbytes matmuls are not capturable).
+CUDA_GRAPHS = (
+    DEVICE == "cuda"
+    and not COMPILE
+    and not LOAD_IN_8BIT
+    and os.getenv("FLORENCE_CUDA_GRAPHS", "0") == "1"
+)
+# Concurrent /caption requests are coalesced into one generate() call of up to
+# GPU_BATCH images, waiting at most BATCH_WAIT_MS for the batch to fill.
+GPU_BATCH = max(1, int(os.getenv("FLORENCE_GPU_BATCH", "8")))
+BATCH_WAIT_MS = max(0.0, float(os.getenv("FLORENCE_BATCH_WAIT_MS", "20")))
+PREPROC_WORKERS = max(1, int(os.getenv("FLORENCE_PREPROC_WORKERS", str(os.cpu_count() or 1))))
+MAX_UPLOAD_BYTES = int(os.getenv("FLORENCE_MAX_UPLOAD_MB", "50")) * 1024 * 1024
+# /caption_path only reads images under this directory (the compose data mount).
+DATA_DIR = os.path.realpath(os.getenv("FLORENCE_DATA_DIR", "/workspace/data"))
+MAX_BATCH_FILES = max(1, int(os.getenv("FLORENCE_MAX_BATCH_FILES", "256")))
+# LRU of parsed results keyed by upload content; 0 disables it.
+CACHE_SIZE = max(0, int(os.getenv("FLORENCE_CACHE", "1024")))
 
 app = FastAPI(title="Florence-2 API", version="1.0.0")
 
+torch.set_float32_matmul_precision("high")
+# Autotune conv algorithms per input shape; the startup warmup pays for it.
+torch.backends.cudnn.benchmark = True
+
 processor = AutoProcessor.from_pretrained(MODEL_ID, trust_remote_code=True)
+# Side length the processor resizes every image to (768 for Florence-2). JPEGs
+# are DCT-scaled to no smaller than this while decoding, and decoded images are
+# shrunk to at most twice this before preprocessing.
+_crop_size = getattr(processor.image_processor, "crop_size", None) or processor.image_processor.size
+TARGET_SIZE = max(_crop_size["height"], _crop_size["width"])
+
+load_kwargs = {}
+if ATTN_IMPL:
+    load_kwargs["attn_implementation"] = ATTN_IMPL
+if LOAD_IN_8BIT:
+    from transformers import BitsAndBytesConfig
+
+    load_kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
+    load_kwargs["device_map"] = {"": 0}
 model = AutoModelForCausalLM.from_pretrained(
     MODEL_ID,
     torch_dtype=DTYPE,
     trust_remote_code=True,
-).to(DEVICE)
+    **load_kwargs,
+)
+if not LOAD_IN_8BIT:
+    # Quantized models are placed by device_map and cannot be moved with .to().
+    # channels_last lets the DaViT conv layers use the cuDNN NHWC kernels.
+    model = model.to(DEVICE, memory_format=torch.channels_last)
 model.eval()
+if DEVICE == "cuda":
+    # Release transient buffers left over from from_pretrained().
+    torch.cuda.empty_cache()
+if COMPILE:
+    # generate() is a Python loop, so compile the modules it calls into instead.
+    # _encode_image() calls the DaViT tower via forward_features_unpool, not forward.
+    model.vision_tower.forward_features_unpool = torch.compile(
+        model.vision_tower.forward_features_unpool, mode="reduce-overhead", fullgraph=False
+    )
+    model.language_model.forward = torch.compile(
+        model.language_model.forward, mode="reduce-overhead", fullgraph=False
+    )
+
+# The processor output schema is fixed, so resolve once which tensors generate()
+# consumes and which need the model dtype instead of checking per request.
+MODEL_INPUTS = ("input_ids", "pixel_values")
+_probe = processor(text=DEFAULT_TASK, images=Image.new("RGB", (224, 224)), return_tensors="pt")
+FLOAT_KEYS = {key for key in MODEL_INPUTS if torch.is_floating_point(_probe[key])}
+if FLOAT_KEYS != {"pixel_values"}:
+    raise RuntimeError(f"Unexpected processor output schema: float inputs {sorted(FLOAT_KEYS)}")
+del _probe
+
+# Image decode and processor() run here so they never block the event loop and
+# overlap with generate() for earlier requests.
+PREPROC_POOL = ThreadPoolExecutor(max_workers=PREPROC_WORKERS, thread_name_prefix="florence-preproc")
+_preproc_slots = asyncio.Semaphore(PREPROC_WORKERS)
+# All model work, including host-to-device copies, runs on this one thread.
+GPU_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="florence-gpu")
+
+_queue: "asyncio.Queue | None" = None
+_batch_task: "asyncio.Task | None" = None
+_encoder_graphs: dict = {}
+_cache: OrderedDict = OrderedDict()
+
+
+def _cache_get(key: tuple) -> Optional[dict]:
+    parsed = _cache.get(key)
+    if parsed is not None:
+        _cache.move_to_end(key)
+    return parsed
+
+
+def _cache_put(key: tuple, parsed: dict) -> None:
+    if CACHE_SIZE == 0:
+        return
+    _cache[key] = parsed
+    _cache.move_to_end(key)
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def _decode(payload: bytes) -> tuple:
+    """Decode an upload to RGB; returns the image and its original (width, height)."""
+    if _jpeg is not None and payload[:3] == b"\xff\xd8\xff":
+        try:
+            width, height, _, _ = _jpeg.decode_header(payload)
+            array = _jpeg.decode(payload, pixel_format=TJPF_RGB, scaling_factor=_jpeg_scaling(width, height))
+            return _shrink(Image.fromarray(array)), (width, height)
+        except OSError:
+            # e.g. CMYK JPEGs that cannot be converted to RGB; let PIL try.
+            pass
+    image = Image.open(io.BytesIO(payload))
+    original_size = image.size
+    if image.format == "JPEG":
+        image.draft("RGB", (TARGET_SIZE, TARGET_SIZE))
+    return _shrink(image.convert("RGB")), original_size
+
+
+def _jpeg_scaling(width: int, height: int) -> tuple:
+    """Smallest libjpeg-turbo scaling factor that keeps both sides >= TARGET_SIZE."""
+    best = (1, 1)
+    for num, denom in _jpeg.scaling_factors:
+        if num / denom < best[0] / best[1] and min(width, height) * num >= TARGET_SIZE * denom:
+            best = (num, denom)
+    return best
+
+
+def _shrink(image: Image.Image) -> Image.Image:
+    # Cuts the processor's resize/normalize work on multi-megapixel uploads.
+    image.thumbnail((TARGET_SIZE * 2, TARGET_SIZE * 2), Image.Resampling.BILINEAR)
+    return image
+
+
+async def _read_upload(file: UploadFile) -> bytes:
+    # Starlette has already spooled the upload, so its size is usually known up front.
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Image exceeds {MAX_UPLOAD_BYTES} bytes")
+    payload = await file.read(MAX_UPLOAD_BYTES + 1)
+    if len(payload) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Image exceeds {MAX_UPLOAD_BYTES} bytes")
+    return payload
+
+
+def _preprocess(image: Image.Image, task: str) -> dict:
+    inputs = processor(text=task, images=image, return_tensors="pt")
+    if DEVICE != "cuda":
+        return {"input_ids": inputs["input_ids"], "pixel_values": inputs["pixel_values"]}
+    # Pinned buffers let the GPU worker copy with non_blocking=True; the unused
+    # attention_mask is dropped rather than pinned and copied.
+    return {
+        "input_ids": inputs["input_ids"].pin_memory(),
+        "pixel_values": inputs["pixel_values"].pin_memory(),
+    }
+
+
+def _to_gpu(batch: list) -> tuple:
+    """Copy a batch of preprocessed inputs to DEVICE and concatenate them there."""
+    if DEVICE != "cuda":
+        input_ids = torch.cat([item["input_ids"] for item in batch])
+        pixel_values = torch.cat([item["pixel_values"] for item in batch]).to(DTYPE)
+        return input_ids, pixel_values
+
+    # Pinned sources make these copies asynchronous on the compute stream, so the
+    # host queues the whole batch without waiting on each transfer.
+    input_ids = torch.cat([item["input_ids"].to(DEVICE, non_blocking=True) for item in batch])
+    # Only pixel_values needs the model dtype (bf16/fp16 on CUDA).
+    pixel_values = torch.cat(
+        [
+            item["pixel_values"].to(DEVICE, DTYPE, non_blocking=True, memory_format=torch.channels_last)
+            for item in batch
+        ]
+    )
+    return input_ids, pixel_values
+
+
+class _EncoderGraph:
+    """CUDA graph of model._encode_image for one fixed pixel_values shape."""
+
+    def __init__(self, shape: torch.Size) -> None:
+        self.static_pixels = torch.zeros(shape, device=DEVICE, dtype=DTYPE)
+        # Warm up on a side stream so lazy kernel init is not captured.
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                model._encode_image(self.static_pixels)
+        torch.cuda.current_stream().wait_stream(stream)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_features = model._encode_image(self.static_pixels)
+
+    def __call__(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        self.static_pixels.copy_(pixel_values)
+        self.graph.replay()
+        return self.static_features.clone()
+
+
+def _embed_with_graph(input_ids: torch.Tensor, pixel_values: torch.Tensor) -> torch.Tensor:
+    encoder = _encoder_graphs.get(pixel_values.shape)
+    if encoder is None:
+        encoder = _encoder_graphs[pixel_values.shape] = _EncoderGraph(pixel_values.shape)
+    inputs_embeds = model.get_input_embeddings()(input_ids)
+    inputs_embeds, _ = model._merge_input_ids_with_image_features(encoder(pixel_values), inputs_embeds)
+    return inputs_embeds
+
+
+def _generation_config(task: str, num_beams: Optional[int], max_new_tokens: Optional[int]) -> tuple:
+    default_beams, default_tokens = TASK_GENERATION.get(task, DEFAULT_GENERATION)
+    num_beams = default_beams if num_beams is None else min(max(num_beams, 1), MAX_BEAMS)
+    max_new_tokens = default_tokens if max_new_tokens is None else min(max(max_new_tokens, 1), MAX_NEW_TOKENS)
+    return num_beams, max_new_tokens
+
+
+def _caption_batch(batch: list, image_sizes: list, task: str, num_beams: int, max_new_tokens: int) -> list:
+    input_ids, pixel_values = _to_gpu(batch)
+
+    with torch.inference_mode():
+        if CUDA_GRAPHS and len(batch) == GPU_BATCH:
+            # Florence's generate() skips its own image encoding when given inputs_embeds.
+            vision_inputs = {"inputs_embeds": _embed_with_graph(input_ids, pixel_values)}
+        else:
+            vision_inputs = {"pixel_values": pixel_values}
+        generated_ids = model.generate(
+            input_ids=input_ids,
+            **vision_inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            num_beams=num_beams,
+        )
+
+    # Location tokens are needed, so special tokens stay; but sequences that finish
+    # early in a batch are padded, and post-processing does not strip <pad>.
+    pad_token = processor.tokenizer.pad_token
+    generated_texts = [
+        text.replace(pad_token, "")
+        for text in processor.batch_decode(generated_ids, skip_special_tokens=False)
+    ]
+    return [
+        processor.post_process_generation(text, task=task, image_size=image_size)
+        for text, image_size in zip(generated_texts, image_sizes)
+    ]
+
+
+def _warmup() -> None:
+    """Run the caption pipeline on a blank image so cold-start costs stay off the first request."""
+    image = Image.new("RGB", (TARGET_SIZE, TARGET_SIZE))
+    inputs = _preprocess(image, DEFAULT_TASK)
+    # Cover single requests and, on GPU, full batches (their cuDNN shapes and CUDA graph).
+    batch_sizes = {1, GPU_BATCH} if DEVICE == "cuda" else {1}
+    for batch_size in sorted(batch_sizes):
+        _caption_batch(
+            [inputs] * batch_size,
+            [image.size] * batch_size,
+            DEFAULT_TASK,
+            *_generation_config(DEFAULT_TASK, None, None),
+        )
+    if DEVICE == "cuda":
+        torch.cuda.synchronize()
+
+
+async def _next_batch(queue: asyncio.Queue) -> list:
+    loop = asyncio.get_running_loop()
+    batch = [await queue.get()]
+    deadline = loop.time() + BATCH_WAIT_MS / 1000
+    while len(batch) < GPU_BATCH:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+
+async def _batch_worker(queue: asyncio.Queue) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = await _next_batch(queue)
+        # Only identical prompts and generation settings share a generate() call,
+        # so no request is padded or decoded with another request's settings.
+        groups: dict = {}
+        for item in batch:
+            # Skip requests whose caller already gave up (e.g. a failed /caption_batch).
+            if not item[3].done():
+                groups.setdefault(item[2], []).append(item)
+        for (task, num_beams, max_new_tokens), items in groups.items():
+            batch_inputs = [inputs for inputs, _, _, _ in items]
+            image_sizes = [image_size for _, image_size, _, _ in items]
+            try:
+                results = await loop.run_in_executor(
+                    GPU_POOL, _caption_batch, batch_inputs, image_sizes, task, num_beams, max_new_tokens
+                )
+            except Exception as ex:
+                for *_, future in items:
+                    if not future.done():
+                        future.set_exception(ex)
+                continue
+            for (*_, future), parsed in zip(items, results):
+                if not future.done():
+                    future.set_result(parsed)
+
+
+@app.on_event("startup")
+async def start_batch_worker() -> None:
+    global _queue, _batch_task
+    # cuDNN autotuning, lazy kernel loading and torch.compile happen here, not on the first request.
+    await asyncio.get_running_loop().run_in_executor(GPU_POOL, _warmup)
+    _queue = asyncio.Queue()
+    _batch_task = asyncio.create_task(_batch_worker(_queue))
+
 
 @app.get("/health")
 def health() -> dict:
     return {"status": "ok", "model_id": MODEL_ID, "device": DEVICE}
 
 
-@app.post("/caption")
-async def caption(file: UploadFile = File(...), task: str = Form(DEFAULT_TASK)) -> dict:
-    try:
-        payload = await file.read()
-        image = Image.open(io.BytesIO(payload)).convert("RGB")
-    except Exception as ex:
-        raise HTTPException(status_code=400, detail=f"Invalid image: {ex}")
+def _read_data_file(path: str) -> bytes:
+    """Read an image under DATA_DIR; relative paths are resolved against it."""
+    resolved = os.path.realpath(os.path.join(DATA_DIR, path))
+    if os.path.commonpath([resolved, DATA_DIR]) != DATA_DIR:
+        raise HTTPException(status_code=403, detail=f"Path is outside {DATA_DIR}")
+    if not os.path.isfile(resolved):
+        raise HTTPException(status_code=404, detail=f"Image not found: {path}")
+    if os.path.getsize(resolved) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Image exceeds {MAX_UPLOAD_BYTES} bytes")
+    with open(resolved, "rb") as f:
+        return f.read()
 
-    inputs = processor(text=task, images=image, return_tensors="pt")
-    # Keep tensor dtypes aligned with the loaded model (fp16 on CUDA, fp32 on CPU).
-    cast_inputs = {}
-    for key, value in inputs.items():
-        if torch.is_floating_point(value):
-            cast_inputs[key] = value.to(device=DEVICE, dtype=DTYPE)
-        else:
-            cast_inputs[key] = value.to(device=DEVICE)
-    inputs = cast_inputs
-
-    generated_ids = model.generate(
-        input_ids=inputs["input_ids"],
-        pixel_values=inputs["pixel_values"],
-        max_new_tokens=256,
-        do_sample=False,
-        num_beams=3,
-    )
 
-    generated_text = processor.batch_decode(generated_ids, skip_special_tokens=False)[0]
-    parsed = processor.post_process_generation(generated_text, task=task, image_size=image.size)
+async def _caption_payload(payload: bytes, task: str, generation: tuple) -> dict:
+    cache_key = (task, *generation, hashlib.blake2b(payload, digest_size=16).digest())
+    parsed = _cache_get(cache_key)
+    if parsed is not None:
+        return parsed
+
+    loop = asyncio.get_running_loop()
+    async with _preproc_slots:
+        try:
+            image, image_size = await loop.run_in_executor(PREPROC_POOL, _decode, payload)
+        except Exception as ex:
+            raise HTTPException(status_code=400, detail=f"Invalid image: {ex}")
+        inputs = await loop.run_in_executor(PREPROC_POOL, _preprocess, image, task)
+
+    future = loop.create_future()
+    # Detection-style tasks map boxes back onto the original, not the draft-decoded, size.
+    await _queue.put((inputs, image_size, (task, *generation), future))
+    parsed = await future
+    _cache_put(cache_key, parsed)
+    return parsed
+
+
+@app.post("/caption")
+async def caption(
+    file: UploadFile = File(...),
+    task: str = Form(DEFAULT_TASK),
+    num_beams: Optional[int] = Form(None),
+    max_new_tokens: Optional[int] = Form(None),
+) -> dict:
+    generation = _generation_config(task, num_beams, max_new_tokens)
+    payload = await _read_upload(file)
+    parsed = await _caption_payload(payload, task, generation)
 
     return {
         "model_id": MODEL_ID,
         "task": task,
         "result": parsed,
     }
+
+
+@app.post("/caption_path")
+async def caption_path(
+    path: str = Form(...),
+    task: str = Form(DEFAULT_TASK),
+    num_beams: Optional[int] = Form(None),
+    max_new_tokens: Optional[int] = Form(None),
+) -> dict:
+    generation = _generation_config(task, num_beams, max_new_tokens)
+    # Reads straight from the mounted dataset, skipping the multipart upload.
+    payload = await asyncio.get_running_loop().run_in_executor(PREPROC_POOL, _read_data_file, path)
+    parsed = await _caption_payload(payload, task, generation)
+
     return {
         "model_id": MODEL_ID,
         "task": task,
         "result": parsed,
     }
+
+
+@app.post("/caption_batch")
+async def caption_batch(
+    files: List[UploadFile] = File(...),
+    task: str = Form(DEFAULT_TASK),
+    num_beams: Optional[int] = Form(None),
+    max_new_tokens: Optional[int] = Form(None),
+) -> dict:
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_FILES} files per request")
+    generation = _generation_config(task, num_beams, max_new_tokens)
+
+    async def caption_file(file: UploadFile) -> dict:
+        try:
+            payload = await _read_upload(file)
+            return await _caption_payload(payload, task, generation)
+        except HTTPException as ex:
+            raise HTTPException(status_code=ex.status_code, detail=f"{file.filename}: {ex.detail}")
+
+    # Read and preprocess one GPU_BATCH chunk at a time so a large request never
+    # holds every payload and pinned pixel_values tensor in memory at once.
+    results = []
+    for start in range(0, len(files), GPU_BATCH):
+        chunk = [asyncio.create_task(caption_file(file)) for file in files[start : start + GPU_BATCH]]
+        try:
+            results.extend(await asyncio.gather(*chunk))
+        except BaseException:
+            # The response has failed; stop the sibling files' remaining work.
+            for pending in chunk:
+                pending.cancel()
+            raise
+
+    return {
+        "model_id": MODEL_ID,
+        "task": task,
+        "results": results,
+    }
@@ -1,11 +1,14 @@
 import argparse
+import atexit
+import codecs
 import csv
-import json
+import io
 import os
 import time
 import threading
 
 import gradio as gr
+import orjson
 
 # Patch gradio_client bool schema handling (avoids API info crash in some versions).
 try:
@@ -29,11 +32,31 @@ try:
 except Exception:
     pass
 
-DATA = []
+# Captions are held column-wise: one list per field, indexed by record.
+IMAGES = []
+RAW = []
+FINAL = []
+# display_path() of each record's image, resolved once at startup (it stats the filesystem).
+IMAGE_PATHS = []
 JSON_PATH = ""
 CSV_PATH = ""
 DATA_DIR = ""
 
+# Button states returned for the five nav buttons; built once, not per click.
+_BTN_ON = gr.update(interactive=True)
+_BTN_OFF = gr.update(interactive=False)
+_NAV_ON_TUP = (_BTN_ON,) * 5
+_NAV_OFF_TUP = (_BTN_OFF,) * 5
+
+# Edits are written after SAVE_DELAY seconds without further edits, not per click.
+SAVE_DELAY = 2.0
+DIRTY = set()
+_save_lock = threading.Lock()
+_save_timer = None
+# Outcome of the most recent save, shown in the status line.
+_last_saved = ""
+_last_save_error = ""
+
 
 def schedule_exit(delay=0.5):
     def _exit_later():
@@ -45,29 +68,85 @@ def schedule_exit(delay=0.5):
 
 
 def load_captions(json_path: str):
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    # Ensure keys exist
+    with open(json_path, "rb") as f:
+        payload = f.read()
+    # Windows PowerShell writes a UTF-8 BOM, which orjson rejects.
+    if payload.startswith(codecs.BOM_UTF8):
+        payload = payload[len(codecs.BOM_UTF8):]
+    data = orjson.loads(payload)
+    images = []
+    raw = []
+    final = []
+    # Missing captions default to "", and a missing final caption to the raw one.
     for item in data:
-        item.setdefault("raw_caption", "")
-        item.setdefault("final_caption", item.get("raw_caption", ""))
-    return data
-
-
-def save_files(data, json_path, csv_path):
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+        raw_caption = item.get("raw_caption", "")
+        final_caption = item.get("final_caption")
+        images.append(item.get("image", ""))
+        raw.append(raw_caption)
+        final.append(raw_caption if final_caption is None else final_caption)
+    return {"images": images, "raw": raw, "final": final}
+
+
+def save_files(images, raw, final, json_path, csv_path):
+    data = [
+        {"image": image, "raw_caption": raw_caption, "final_caption": final_caption}
+        for image, raw_caption, final_caption in zip(images, raw, final)
+    ]
+    with open(json_path, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    # Build the CSV in memory and write it in one call.
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["image", "raw_caption", "final_caption"])
+    writer.writerows(zip(images, raw, final))
     with open(csv_path, "w", encoding="utf-8", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=["image", "raw_caption", "final_caption"])
-        writer.writeheader()
-        for row in data:
-            writer.writerow(
-                {
-                    "image": row.get("image", ""),
-                    "raw_caption": row.get("raw_caption", ""),
-                    "final_caption": row.get("final_caption", ""),
-                }
-            )
+        f.write(buf.getvalue())
+
+
+def flush():
+    global _save_timer, _last_saved, _last_save_error
+    with _save_lock:
+        if _save_timer is not None:
+            _save_timer.cancel()
+            _save_timer = None
+        if not DIRTY:
+            return
+        try:
+            save_files(IMAGES, RAW, FINAL, JSON_PATH, CSV_PATH)
+        except Exception as ex:
+            # Keep DIRTY so the next edit or End Task retries the save.
+            _last_save_error = f"{type(ex).__name__}: {ex}"
+            raise
+        DIRTY.clear()
+        _last_saved = time.strftime("%H:%M:%S")
+        _last_save_error = ""
+
+
+def save_status(changed):
+    if _last_save_error:
+        return f"**Save failed:** {_last_save_error}. Edits are kept and will be retried."
+    parts = []
+    if changed:
+        parts.append(f"Edited {time.strftime('%H:%M:%S')}, autosaving")
+    if _last_saved:
+        parts.append(f"last saved {_last_saved}")
+    return "; ".join(parts)
+
+
+def update_caption(idx, caption_text):
+    """Store an edited caption and (re)start the idle save timer. Returns True if it changed."""
+    global _save_timer
+    with _save_lock:
+        if FINAL[idx] == caption_text:
+            return False
+        FINAL[idx] = caption_text
+        DIRTY.add(idx)
+        if _save_timer is not None:
+            _save_timer.cancel()
+        _save_timer = threading.Timer(SAVE_DELAY, flush)
+        _save_timer.daemon = True
+        _save_timer.start()
+    return True
 
 
 def clamp_index(idx, length):
@@ -76,15 +155,8 @@ def clamp_index(idx, length):
     return max(0, min(idx, length - 1))
 
 
-def get_record(idx):
-    if not DATA:
-        return None, 0
-    idx = clamp_index(idx, len(DATA))
-    return DATA[idx], idx
-
-
 def progress_text(idx):
-    n = len(DATA)
+    n = len(FINAL)
     if n == 0:
         return "No records"
     return f"**{idx + 1} / {n}**"
@@ -102,68 +174,36 @@ def display_path(path_value: str):
 
 
 def nav(direction, caption_text, idx):
-    if not DATA:
-        return (
-            None,
-            "",
-            "No records",
-            "Nothing to save",
-            idx,
-            gr.update(interactive=False),
-            gr.update(interactive=False),
-            gr.update(interactive=False),
-            gr.update(interactive=False),
-            gr.update(interactive=False),
-        )
+    if not FINAL:
+        return (None, "", "No records", "Nothing to save", idx, *_NAV_OFF_TUP)
 
     # Save current caption
-    rec, idx = get_record(idx)
-    rec["final_caption"] = caption_text.strip()
-    save_files(DATA, JSON_PATH, CSV_PATH)
+    idx = clamp_index(idx, len(FINAL))
+    changed = update_caption(idx, caption_text.strip())
 
     if direction == "next":
-        idx = clamp_index(idx + 1, len(DATA))
+        idx = clamp_index(idx + 1, len(FINAL))
     elif direction == "prev":
-        idx = clamp_index(idx - 1, len(DATA))
+        idx = clamp_index(idx - 1, len(FINAL))
     elif direction == "first":
         idx = 0
     elif direction == "last":
-        idx = len(DATA) - 1
+        idx = len(FINAL) - 1
     elif direction == "end":
+        # os._exit skips atexit handlers, so write pending edits now.
+        try:
+            flush()
+        except Exception as ex:
+            status = f"**Save failed:** {type(ex).__name__}: {ex}. Fix the problem and press End Task again."
+            return (IMAGE_PATHS[idx], FINAL[idx], progress_text(idx), status, idx, *_NAV_ON_TUP)
         status = "Session ended. Close this tab if you're done."
-        btn_off = gr.update(interactive=False)
-        rec, idx = get_record(idx)
         schedule_exit()
-        return (
-            display_path(rec.get("image", None)),
-            rec.get("final_caption", ""),
-            progress_text(idx),
-            status,
-            idx,
-            btn_off,
-            btn_off,
-            btn_off,
-            btn_off,
-            btn_off,
-        )
+        return (IMAGE_PATHS[idx], FINAL[idx], progress_text(idx), status, idx, *_NAV_OFF_TUP)
 
-    rec, idx = get_record(idx)
-    img_path = display_path(rec.get("image", ""))
-    cap = rec.get("final_caption", "")
-    status = f"Saved {time.strftime('%H:%M:%S')}"
-    btn_on = gr.update(interactive=True)
-    return (
-        img_path,
-        cap,
-        progress_text(idx),
-        status,
-        idx,
-        btn_on,
-        btn_on,
-        btn_on,
-        btn_on,
-        gr.update(interactive=True),
-    )
+    img_path = IMAGE_PATHS[idx]
+    cap = FINAL[idx]
+    status = save_status(changed)
+    return (img_path, cap, progress_text(idx), status, idx, *_NAV_ON_TUP)
 
 
 
@@ -188,23 +228,10 @@ def nav_end(caption_text, idx):
 
 
 def load_first(idx):
-    if not DATA:
-        off = gr.update(interactive=False)
-        return None, "", "No records", "Nothing to review", idx, off, off, off, off, off
-    rec, idx = get_record(idx)
-    on = gr.update(interactive=True)
-    return (
-        display_path(rec.get("image", "")),
-        rec.get("final_caption", ""),
-        progress_text(idx),
-        "",
-        idx,
-        on,
-        on,
-        on,
-        on,
-        on,
-    )
+    if not FINAL:
+        return (None, "", "No records", "Nothing to review", idx, *_NAV_OFF_TUP)
+    idx = clamp_index(idx, len(FINAL))
+    return (IMAGE_PATHS[idx], FINAL[idx], progress_text(idx), "", idx, *_NAV_ON_TUP)
 
 
 
@@ -216,11 +243,14 @@ def main():
     parser.add_argument("--port", type=int, default=7860, help="Port for Gradio UI")
     args = parser.parse_args()
 
-    global DATA, JSON_PATH, CSV_PATH, DATA_DIR
-    DATA = load_captions(args.captions)
+    global IMAGES, RAW, FINAL, IMAGE_PATHS, JSON_PATH, CSV_PATH, DATA_DIR
+    columns = load_captions(args.captions)
+    IMAGES, RAW, FINAL = columns["images"], columns["raw"], columns["final"]
     JSON_PATH = args.captions
     CSV_PATH = args.csv
     DATA_DIR = os.path.dirname(args.captions)
+    IMAGE_PATHS = [display_path(image) for image in IMAGES]
+    atexit.register(flush)
 
     title = "Caption Review"
     if args.concept: